@@ -9,18 +9,18 @@ ungoogled-chromium build script for Microsoft Windows
 """
 
 import sys
-import time
 
 if sys.version_info.major != 3 or sys.version_info.minor < 8 or sys.version_info.minor > 10:
     raise RuntimeError('Python 3.8 to 3.10 is required for this script. You have: {}.{}'.format(
         sys.version_info.major, sys.version_info.minor))
 
 import argparse
+import functools
 import os
 import re
 import shutil
+import signal
 import subprocess
-import ctypes
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).resolve().parent / 'ungoogled-chromium' / 'utils'))
@@ -33,8 +33,11 @@ sys.path.pop(0)
 
 _ROOT_DIR = Path(__file__).resolve().parent
 _PATCH_BIN_RELPATH = Path('third_party/git/usr/bin/patch.exe')
+_GN_BOOTSTRAP_ARGS = (sys.executable, 'tools\\gn\\bootstrap\\bootstrap.py', '-o', 'out\\Default\\gn.exe',
+                      '--skip-generate-buildfiles')
 
 
+@functools.lru_cache(maxsize=None)
 def _get_vcvars_path(name='64'):
     """
     Returns the path to the corresponding vcvars*.bat path
@@ -55,58 +58,89 @@ def _get_vcvars_path(name='64'):
     return vcvars_path
 
 
+@functools.lru_cache(maxsize=None)
+def _get_build_env():
+    """
+    Returns the environment variables for building, as set up by the vcvars batch script
+
+    vcvars is slow, so it only runs once and every build step reuses its result
+    """
+    # /u makes cmd write the output of set as UTF-16, so non-ASCII values survive
+    result = subprocess.run(
+        'cmd.exe /u /s /c "call "{}" >nul && set"'.format(_get_vcvars_path()),
+        check=True,
+        stdout=subprocess.PIPE)
+    build_env = dict(
+        line.split('=', 1) for line in result.stdout.decode('utf-16-le').splitlines() if '=' in line)
+    build_env['DEPOT_TOOLS_WIN_TOOLCHAIN'] = '0'
+    return build_env
+
+
 def _run_build_process(*args, **kwargs):
     """
     Runs the subprocess with the correct environment variables for building
     """
-    # Add call to set VC variables
-    cmd_input = ['call "%s" >nul' % _get_vcvars_path()]
-    cmd_input.append('set DEPOT_TOOLS_WIN_TOOLCHAIN=0')
-    cmd_input.append(' '.join(map('"{}"'.format, args)))
-    cmd_input.append('exit\n')
-    subprocess.run(('cmd.exe', '/k'),
-                   input='\n'.join(cmd_input),
-                   check=True,
-                   encoding=ENCODING,
-                   **kwargs)
+    subprocess.run(args, env=_get_build_env(), check=True, **kwargs)
 
 
 def _run_build_process_timeout(*args, timeout):
     """
     Runs the subprocess with the correct environment variables for building
     """
-    # Add call to set VC variables
-    cmd_input = ['call "%s" >nul' % _get_vcvars_path()]
-    cmd_input.append('set DEPOT_TOOLS_WIN_TOOLCHAIN=0')
-    cmd_input.append(' '.join(map('"{}"'.format, args)))
-    cmd_input.append('exit\n')
-    with subprocess.Popen(('cmd.exe', '/k'), encoding=ENCODING, stdin=subprocess.PIPE, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP) as proc:
-        proc.stdin.write('\n'.join(cmd_input))
-        proc.stdin.close()
+    with subprocess.Popen(args, env=_get_build_env(), creationflags=subprocess.CREATE_NEW_PROCESS_GROUP) as proc:
         try:
             proc.wait(timeout)
             if proc.returncode != 0:
                 raise RuntimeError('Build failed!')
         except subprocess.TimeoutExpired:
-            print('Sending keyboard interrupt')
-            for _ in range(3):
-                ctypes.windll.kernel32.GenerateConsoleCtrlEvent(1, proc.pid)
-                time.sleep(1)
-            try:
-                proc.wait(10)
-            except:
-                proc.kill()
+            _stop_build_process(proc)
             raise KeyboardInterrupt
 
 
+def _stop_build_process(proc):
+    """
+    Interrupts a build process started in its own process group, killing it
+    if it does not exit in time
+    """
+    print('Sending keyboard interrupt')
+    proc.send_signal(signal.CTRL_BREAK_EVENT)
+    try:
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def _start_gn_bootstrap(source_tree, domain_substitution_list):
+    """
+    Starts bootstrapping GN in the background, so it can overlap with domain substitution
+
+    Returns the bootstrap process, or None if domain substitution touches GN's sources
+    and GN has to be bootstrapped afterwards
+    """
+    with domain_substitution_list.open(encoding=ENCODING) as list_file:
+        if any(line.startswith('tools/gn/') for line in list_file):
+            return None
+    (source_tree / 'out/Default').mkdir(parents=True, exist_ok=True)
+    return subprocess.Popen(_GN_BOOTSTRAP_ARGS,
+                            cwd=source_tree,
+                            env=_get_build_env(),
+                            creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+
+
+def _get_patch_paths(patches_dir):
+    """
+    Returns the paths of the patches in patches_dir's series
+
+    patches_dir is already absolute, so this avoids resolving every patch path
+    """
+    return [patches_dir / patch_path for patch_path in patches.generate_patches_from_series(patches_dir)]
+
+
 def _make_tmp_paths():
     """Creates TMP and TEMP variable dirs so ninja won't fail"""
-    tmp_path = Path(os.environ['TMP'])
-    if not tmp_path.exists():
-        tmp_path.mkdir()
-    tmp_path = Path(os.environ['TEMP'])
-    if not tmp_path.exists():
-        tmp_path.mkdir()
+    for tmp_var in ('TMP', 'TEMP'):
+        Path(os.environ[tmp_var]).mkdir(parents=True, exist_ok=True)
 
 
 def main():
@@ -146,6 +180,7 @@ def main():
     source_tree = _ROOT_DIR / 'build' / 'src'
     downloads_cache = _ROOT_DIR / 'build' / 'download_cache'
 
+    gn_bootstrapped = False
     if not args.ci or not (source_tree / 'BUILD.gn').exists():
         # Setup environment
         source_tree.mkdir(parents=True, exist_ok=True)
@@ -188,10 +223,11 @@ def main():
 
         # Prune binaries
         pruning_list = (_ROOT_DIR / 'ungoogled-chromium' / 'pruning.list') if args.tarball else (_ROOT_DIR  / 'pruning.list')
-        unremovable_files = prune_binaries.prune_files(
-            source_tree,
-            pruning_list.read_text(encoding=ENCODING).splitlines()
-        )
+        with pruning_list.open(encoding=ENCODING) as pruning_file:
+            unremovable_files = prune_binaries.prune_files(
+                source_tree,
+                (line.rstrip('\n') for line in pruning_file)
+            )
         if unremovable_files:
             get_logger().error('Files could not be pruned: %s', unremovable_files)
             parser.exit(1)
@@ -199,25 +235,35 @@ def main():
         # Apply patches
         # First, ungoogled-chromium-patches
         patches.apply_patches(
-            patches.generate_patches_from_series(_ROOT_DIR / 'ungoogled-chromium' / 'patches', resolve=True),
+            _get_patch_paths(_ROOT_DIR / 'ungoogled-chromium' / 'patches'),
             source_tree,
             patch_bin_path=(source_tree / _PATCH_BIN_RELPATH)
         )
         # Then Windows-specific patches
         patches.apply_patches(
-            patches.generate_patches_from_series(_ROOT_DIR / 'patches', resolve=True),
+            _get_patch_paths(_ROOT_DIR / 'patches'),
             source_tree,
             patch_bin_path=(source_tree / _PATCH_BIN_RELPATH)
         )
 
-        # Substitute domains
+        # Substitute domains, bootstrapping GN meanwhile
         domain_substitution_list = (_ROOT_DIR / 'ungoogled-chromium' / 'domain_substitution.list') if args.tarball else (_ROOT_DIR  / 'domain_substitution.list')
-        domain_substitution.apply_substitution(
-            _ROOT_DIR / 'ungoogled-chromium' / 'domain_regex.list',
-            domain_substitution_list,
-            source_tree,
-            None
-        )
+        gn_bootstrap = _start_gn_bootstrap(source_tree, domain_substitution_list)
+        try:
+            domain_substitution.apply_substitution(
+                _ROOT_DIR / 'ungoogled-chromium' / 'domain_regex.list',
+                domain_substitution_list,
+                source_tree,
+                None
+            )
+            if gn_bootstrap is not None:
+                if gn_bootstrap.wait() != 0:
+                    raise subprocess.CalledProcessError(gn_bootstrap.returncode, gn_bootstrap.args)
+                gn_bootstrapped = True
+        finally:
+            # Do not leave the bootstrap (and its compilers) running if anything failed
+            if gn_bootstrap is not None and gn_bootstrap.poll() is None:
+                _stop_build_process(gn_bootstrap)
 
     # Check if rust-toolchain folder has been populated
     HOST_CPU_IS_64BIT = sys.maxsize > 2**32
@@ -255,28 +301,28 @@ def main():
             f.write('rustc 1.79.0-nightly (ef8b9dcf2 2024-04-24)')
             f.write('\n')
 
-    if not args.ci or not (source_tree / 'out/Default').exists():
+    if not args.ci or not (source_tree / 'out/Default/args.gn').exists():
         # Output args.gn
-        (source_tree / 'out/Default').mkdir(parents=True)
+        (source_tree / 'out/Default').mkdir(parents=True, exist_ok=True)
         gn_flags = (_ROOT_DIR / 'ungoogled-chromium' / 'flags.gn').read_text(encoding=ENCODING)
-        gn_flags += '\n'
         windows_flags = (_ROOT_DIR / 'flags.windows.gn').read_text(encoding=ENCODING)
         if args.x86:
             windows_flags = windows_flags.replace('x64', 'x86')
-        gn_flags += windows_flags
-        (source_tree / 'out/Default/args.gn').write_text(gn_flags, encoding=ENCODING)
+        (source_tree / 'out/Default/args.gn').write_text('\n'.join((gn_flags, windows_flags)),
+                                                         encoding=ENCODING)
 
     # Enter source tree to run build commands
     os.chdir(source_tree)
 
-    if not args.ci or not os.path.exists('out\\Default\\gn.exe'):
+    gn_gen_args = ('out\\Default\\gn.exe', 'gen', 'out\\Default', '--fail-on-unused-args')
+    if not gn_bootstrapped and (not args.ci or not os.path.exists('out\\Default\\gn.exe')):
         # Run GN bootstrap
-        _run_build_process(
-            sys.executable, 'tools\\gn\\bootstrap\\bootstrap.py', '-o', 'out\\Default\\gn.exe',
-            '--skip-generate-buildfiles')
-
+        _run_build_process(*_GN_BOOTSTRAP_ARGS)
+        gn_bootstrapped = True
+    # gn.exe can exist without gn gen having run, e.g. if a CI stage failed in between
+    if gn_bootstrapped or not os.path.exists('out\\Default\\build.ninja'):
         # Run gn gen
-        _run_build_process('out\\Default\\gn.exe', 'gen', 'out\\Default', '--fail-on-unused-args')
+        _run_build_process(*gn_gen_args)
     # Run ninja
     if args.ci:
         _run_build_process_timeout('third_party\\ninja\\ninja.exe', '-C', 'out\\Default', 'chrome',